@@ -1,10 +1,15 @@
 from collections import defaultdict
 from pathlib import Path
+import re
+from typing import Dict, Iterator, List, Tuple
 
 import joblib
 from loguru import logger
+import numpy as np
 import polars as pl
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import KFold
 
@@ -12,24 +17,166 @@ from src.utils.config import Config
 
 
 ROOT = Path(__file__).parents[2]
+FEATURES_PATH = ROOT / "data/processed/df_acc_ind.parquet"
 N_SPLITS = 5
 
 
-if __name__ == "__main__":
-    model_dir = ROOT / "models/rf"
-    model_dir.mkdir(parents=True, exist_ok=True)
-    config = Config(additional_save_paths=[model_dir / "config.yaml"])
+def select_feature_columns(config: Dict, columns: List[str], index_label: str) -> List[str]:
+    """
+    Match the configured feature regexes against the column names, mirroring `DataFrame.filter(regex=...)`
+    so that the out of core mode trains on exactly the same columns as the in memory mode.
+    """
+    pattern = re.compile(
+        r"|".join(config["accident_features"] + config["additional_rollup_features"])
+    )
+    return [c for c in columns if c != index_label and pattern.search(c)]
 
-    index_label = "postcode"
-    df_train = pd.read_parquet(ROOT / "data/processed/df_acc_ind.parquet").set_index(index_label)
+
+def iter_feature_batches(
+    parquet_file: pq.ParquetFile,
+    feature_cols: List[str],
+    response: str,
+    index_label: str,
+    batch_size: int,
+) -> Iterator[Tuple[int, pd.Index, pd.DataFrame, pd.Series]]:
+    """
+    Stream the feature dataset in batches, only reading the required columns and casting features to
+    float32 in arrow before converting to pandas so the full frame is never materialised.
+
+    Yields the row offset of the batch within the file along with the index, features and response.
+    """
+    float32_schema = pa.schema([(c, pa.float32()) for c in feature_cols])
+    offset = 0
+    for batch in parquet_file.iter_batches(
+        batch_size=batch_size, columns=[index_label, *feature_cols, response]
+    ):
+        table = pa.Table.from_batches([batch])
+        index = pd.Index(table.column(index_label).to_pandas(), name=index_label)
+        X_batch = table.select(feature_cols).cast(float32_schema).to_pandas()
+        X_batch.index = index
+        y_batch = table.column(response).to_pandas()
+        y_batch.index = index
+        yield offset, index, X_batch, y_batch
+        offset += batch.num_rows
+
+
+def read_out_of_core_config(config: Dict) -> Tuple[int, int]:
+    """Read the `out_of_core` `batch_size` and `trees_per_batch`, checking they are positive integers"""
+    ooc_config = config["out_of_core"]
+    values = []
+    for key in ["batch_size", "trees_per_batch"]:
+        value = ooc_config.get(key)
+        if isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            raise ValueError(f"out_of_core.{key} must be a positive integer, got {value!r}")
+        values.append(value)
+    return tuple(values)
+
+
+def n_trees_for_batch(n_train: int, batch_size: int, trees_per_batch: int) -> int:
+    """
+    Scale the trees added for a batch by its number of training rows, so that short batches (the
+    remainder at the end of the file or batches cut at row group boundaries) do not get the same vote as
+    full ones. Batches too small to earn a single tree are skipped.
+    """
+    return round(trees_per_batch * n_train / batch_size)
+
+
+def train_out_of_core(config: Dict, model_dir: Path, index_label: str) -> List[Path]:
+    """
+    Cross validated training which grows each split's forest with `warm_start`, adding trees fitted on
+    the training rows of every batch of the feature dataset.
+
+    All splits are trained in a single pass over the file and predicted in a second pass. Writes the
+    same per split `rf.joblib` and `preds.parquet` outputs as the in memory mode.
+    """
+    batch_size, trees_per_batch = read_out_of_core_config(config)
+    parquet_file = pq.ParquetFile(FEATURES_PATH)
+    feature_cols = select_feature_columns(config, parquet_file.schema_arrow.names, index_label)
+    n_rows = parquet_file.metadata.num_rows
+    if n_rows < N_SPLITS:
+        raise ValueError(f"{FEATURES_PATH} has {n_rows} rows, need at least {N_SPLITS} to split")
+    hyperparams = {k: v for k, v in config["hyperparams"].items() if k != "n_estimators"}
+    seed = config["general"]["random_seed"]
+
+    # Split number of the test fold each row belongs to
+    test_fold = np.empty(n_rows, dtype=np.int8)
+    for i, (_, test_index) in enumerate(
+        KFold(n_splits=N_SPLITS, random_state=seed, shuffle=True).split(np.empty((n_rows, 0)))
+    ):
+        test_fold[test_index] = i
+    forests = [
+        RandomForestRegressor(**hyperparams, n_estimators=0, warm_start=True, random_state=seed)
+        for _ in range(N_SPLITS)
+    ]
+
+    logger.info(f"Training {N_SPLITS} splits on {n_rows} rows...")
+    for offset, _, X_batch, y_batch in iter_feature_batches(
+        parquet_file, feature_cols, config["response"], index_label, batch_size
+    ):
+        batch_fold = test_fold[offset : offset + len(X_batch)]
+        for i, rf in enumerate(forests):
+            train_mask = batch_fold != i
+            n_trees = n_trees_for_batch(int(train_mask.sum()), batch_size, trees_per_batch)
+            if n_trees == 0:
+                logger.warning(
+                    f"Split {i + 1}: skipping {train_mask.sum()} training rows in batch at row {offset}"
+                )
+                continue
+            rf.n_estimators += n_trees
+            rf.fit(X_batch[train_mask], y_batch[train_mask])
+            logger.info(f"Split {i + 1}: {rf.n_estimators} trees after batch at row {offset}")
+
+    split_dirs = []
+    for i, rf in enumerate(forests):
+        if rf.n_estimators == 0:
+            raise ValueError(
+                f"No trees were fitted for split {i + 1} ({n_rows} rows with batch_size {batch_size}), "
+                "reduce out_of_core.batch_size or increase out_of_core.trees_per_batch"
+            )
+        split_dir = model_dir / f"split_{i + 1}"
+        split_dir.mkdir(parents=True, exist_ok=True)
+        split_dirs.append(split_dir)
+        joblib.dump(rf, split_dir / "rf.joblib")
+
+    logger.info(f"Predicting {N_SPLITS} splits...")
+    writers = [None] * N_SPLITS
+    for offset, index, X_batch, y_batch in iter_feature_batches(
+        parquet_file, feature_cols, config["response"], index_label, batch_size
+    ):
+        batch_fold = test_fold[offset : offset + len(X_batch)]
+        for i, rf in enumerate(forests):
+            test_mask = batch_fold == i
+            if not test_mask.any():
+                continue
+            preds_table = pa.Table.from_pandas(
+                pd.DataFrame(
+                    {
+                        "y_true": y_batch[test_mask],
+                        "y_pred": rf.predict(X_batch[test_mask]),
+                    },
+                    index=index[test_mask],
+                )
+            )
+            if writers[i] is None:
+                writers[i] = pq.ParquetWriter(split_dirs[i] / "preds.parquet", preds_table.schema)
+            writers[i].write_table(preds_table)
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+
+    return split_dirs
+
+
+def train_in_memory(config: Dict, model_dir: Path, index_label: str) -> List[Path]:
+    df_train = pd.read_parquet(FEATURES_PATH).set_index(index_label)
     X = df_train.filter(
-        regex=r"|".join(config()["accident_features"] + config()["additional_rollup_features"]),
+        regex=r"|".join(config["accident_features"] + config["additional_rollup_features"]),
         axis=1,
     ).copy()
-    y = df_train[config()["response"]]
+    y = df_train[config["response"]]
 
     results = defaultdict(list)
-    seed = config()["general"]["random_seed"]
+    seed = config["general"]["random_seed"]
     split_dirs = []
     for i, (train_index, test_index) in enumerate(
         KFold(n_splits=N_SPLITS, random_state=seed, shuffle=True).split(X)
@@ -50,7 +197,7 @@ if __name__ == "__main__":
         logger.info(f"Training {i}...")
 
         rf = RandomForestRegressor(
-            **config()["hyperparams"],
+            **config["hyperparams"],
             random_state=seed,
         )
         rf.fit(X_train, y_train)
@@ -67,6 +214,20 @@ if __name__ == "__main__":
             index=X.index[test_index],
         ).to_parquet(split_dir / "preds.parquet")
 
+    return split_dirs
+
+
+if __name__ == "__main__":
+    model_dir = ROOT / "models/rf"
+    model_dir.mkdir(parents=True, exist_ok=True)
+    config = Config(additional_save_paths=[model_dir / "config.yaml"])
+
+    index_label = "postcode"
+    if config().get("out_of_core", {}).get("enabled", False):
+        split_dirs = train_out_of_core(config(), model_dir, index_label)
+    else:
+        split_dirs = train_in_memory(config(), model_dir, index_label)
+
     # Combine the parquet files into out long preds file which only has the test values in.
     # Used polars for speed and efficient memory management
     pl.concat(